@@ -1,28 +1,99 @@
+import io
 import os
 import base64
 import json
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import IO, Any, List, Optional, Tuple
 
+import ijson
+import orjson
 from flask import Flask, request, jsonify, render_template
+from flask.json.provider import JSONProvider
 
-from .database import init_db, get_user_by_qr, insert_log
-from .liveness import is_live_from_base64_frames
+from .database import init_db, get_user_by_qr, insert_log, start_log_writer
+from .liveness import liveness_from_base64_frames, decode_base64_image
 from .face_utils import compare_face_with_user
 
 
-def create_app():
+class ORJSONProvider(JSONProvider):
+    """Serializacja JSON Flaska (jsonify, get_json) przez orjson."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
+def _utcnow() -> datetime:
+    # naiwny datetime w UTC – w takim formacie zapisywany jest logs.timestamp
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _read_verify_payload(stream: IO[bytes]) -> Tuple[Any, Optional[List[str]]]:
+    """
+    Odczytuje qr_code i frames z ciała żądania /verify przyrostowo (ijson),
+    bez budowania w pamięci całego dokumentu JSON obok surowych bajtów.
+    Przy niepoprawnej strukturze frames zwraca None.
+    """
+    # ijson sprawdza typ strumienia przez read(0); LimitedStream Werkzeuga
+    # (serwer deweloperski, test_client) traktuje pusty odczyt jako zerwane
+    # połączenie, więc surowy strumień opakowujemy buforem.
+    if isinstance(stream, io.RawIOBase):
+        stream = io.BufferedReader(stream)
+
+    qr_code = None
+    frames: Optional[List[str]] = None
+    frames_valid = True
+
+    try:
+        for prefix, event, value in ijson.parse(stream):
+            if prefix == "" and event not in ("start_map", "end_map", "map_key"):
+                return None, None
+            if prefix == "qr_code":
+                qr_code = value
+            elif prefix == "frames":
+                if event == "start_array":
+                    frames = []
+                elif event != "end_array":
+                    frames_valid = False
+            elif prefix == "frames.item":
+                if event == "string" and frames is not None:
+                    frames.append(value)
+                elif event not in ("end_map", "end_array"):
+                    frames_valid = False
+    except ijson.JSONError:
+        return None, None
+
+    return qr_code, frames if frames_valid else None
+
+
+def create_app(db_path: Optional[str] = None):
     base_dir = os.path.abspath(os.path.dirname(__file__))
-    db_path = os.path.join(base_dir, "database.sqlite3")
+    if db_path is None:
+        db_path = os.path.join(base_dir, "database.sqlite3")
 
     app = Flask(
         __name__,
         template_folder=os.path.join(base_dir, "templates"),
         static_folder=os.path.join(base_dir, "static"),
     )
+    app.json = ORJSONProvider(app)
     app.config["DATABASE_PATH"] = db_path
 
     # Ensure DB exists
     init_db(db_path)
+    start_log_writer(db_path)
+
+    # Test żywotności uruchamiamy w stałej puli wątków: każdy z nich trzyma
+    # własny FaceMesh (liveness._get_face_mesh), więc nie jest on budowany od
+    # nowa dla każdego wątku żądania. MediaPipe i OpenCV zwalniają GIL, więc
+    # wystarczą wątki – bez picklowania klatek i ładowania modeli per proces.
+    # Porównanie twarzy czeka na prostokąt twarzy z testu żywotności, więc
+    # równolegle z testem wykonuje się tylko odczyt użytkownika – zwykle
+    # trafienie w cache get_user_by_qr.
+    executor = ThreadPoolExecutor(max_workers=os.cpu_count())
 
     @app.route("/", methods=["GET"])
     def index():
@@ -30,11 +101,21 @@ def create_app():
 
     @app.route("/verify", methods=["POST"])
     def verify():
-        data = request.get_json(silent=True) or {}
-        qr_code = data.get("qr_code")
-        frames = data.get("frames", [])
-
-        if not qr_code or not frames:
+        qr_code, frames = None, None
+        if request.is_json:
+            qr_code, frames = _read_verify_payload(request.stream)
+
+        # Niepoprawne żądania odrzucamy przed jakimkolwiek dekodowaniem
+        # i bez zapisu do bazy – tanio, nawet przy dużym ruchu.
+        if (
+            not qr_code
+            or not isinstance(qr_code, str)
+            or not frames
+        ):
+            app.logger.warning(
+                "Odrzucono /verify z %s: brak kodu QR lub klatek.",
+                request.remote_addr,
+            )
             return (
                 jsonify(
                     {
@@ -46,11 +127,22 @@ def create_app():
             )
 
         db_path_local = app.config["DATABASE_PATH"]
+        now = _utcnow()
 
-        # 1. Liveness check
-        is_live = is_live_from_base64_frames(frames)
+        # używamy ostatniej klatki jako referencji do identyfikacji;
+        # dekodujemy ją raz i przekazujemy do obu etapów
+        last_frame_b64 = frames[-1]
+        last_frame_bgr = decode_base64_image(last_frame_b64)
+
+        # 1. Test żywotności w puli, w tym czasie odczyt użytkownika po kodzie QR
+        fut_live = executor.submit(
+            liveness_from_base64_frames, frames, last_frame_bgr=last_frame_bgr
+        )
+        user = get_user_by_qr(db_path_local, qr_code)
+
+        is_live, face_box = fut_live.result()
         if not is_live:
-            insert_log(db_path_local, None, datetime.utcnow(), "Spoofing")
+            insert_log(db_path_local, None, now, "Spoofing")
             return (
                 jsonify(
                     {
@@ -61,10 +153,9 @@ def create_app():
                 200,
             )
 
-        # 2. Identyfikacja po kodzie QR i porównanie twarzy
-        user = get_user_by_qr(db_path_local, qr_code)
+        # 2. Porównanie twarzy z użytkownikiem powiązanym z kodem QR
         if not user:
-            insert_log(db_path_local, None, datetime.utcnow(), "Oszustwo")
+            insert_log(db_path_local, None, now, "Oszustwo")
             return (
                 jsonify(
                     {
@@ -75,12 +166,17 @@ def create_app():
                 200,
             )
 
-        # używamy ostatniej klatki jako referencji do identyfikacji
-        last_frame_b64 = frames[-1]
-        is_match = compare_face_with_user(db_path_local, user, last_frame_b64)
+        # prostokąt twarzy z testu żywotności – bez ponownego wykrywania
+        is_match = compare_face_with_user(
+            db_path_local,
+            user,
+            last_frame_b64,
+            frame_bgr=last_frame_bgr,
+            face_box=face_box,
+        )
 
         if not is_match:
-            insert_log(db_path_local, user["id"], datetime.utcnow(), "Oszustwo")
+            insert_log(db_path_local, user["id"], now, "Oszustwo")
             return (
                 jsonify(
                     {
@@ -92,7 +188,7 @@ def create_app():
             )
 
         # 3. Zapis logu – sukces
-        insert_log(db_path_local, user["id"], datetime.utcnow(), "Sukces")
+        insert_log(db_path_local, user["id"], now, "Sukces")
 
         return jsonify(
             {
@@ -1,24 +1,165 @@
+import atexit
+import json
+import os
+import queue
 import sqlite3
-from typing import Optional, Dict, Any
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, List, Optional, Dict, Any, Tuple
 
+import numpy as np
 
-def get_connection(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+
+# WAL zastępuje fsync przy każdym commicie dopisywaniem do logu i pozwala
+# czytać w trakcie zapisów (/verify przeplata odczyty i inserty).
+# journal_mode jest trwałe w pliku, pozostałe ustawienia obowiązują per
+# połączenie, więc wykonujemy je przy każdym otwarciu.
+_CONNECTION_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-64000;
+PRAGMA mmap_size=268435456;
+PRAGMA wal_autocheckpoint=1000;
+"""
+
+
+STATEMENT_CACHE_SIZE = 256
+
+
+def _open_connection(db_path: str) -> sqlite3.Connection:
+    # Połączenie z puli może trafić do innego wątku przy kolejnym
+    # wypożyczeniu; w danej chwili używa go tylko jeden wątek.
+    # Większy cache przygotowanych zapytań: te same teksty SQL (stałe _SQL_*)
+    # nie są ponownie parsowane i planowane przy każdym wywołaniu.
+    conn = sqlite3.connect(
+        db_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE
+    )
     conn.row_factory = sqlite3.Row
+    conn.executescript(_CONNECTION_PRAGMAS)
     return conn
 
 
+# Pula otwartych połączeń per plik bazy: bez open()/close() i parsowania
+# schematu przy każdym zapytaniu, z zachowaniem cache stron SQLite.
+# Działa niezależnie od tego, czy serwer tworzy wątek na każde żądanie.
+POOL_SIZE = 8
+
+_pools: Dict[str, queue.LifoQueue] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(db_path: str) -> queue.LifoQueue:
+    pool = _pools.get(db_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(db_path, queue.LifoQueue(maxsize=POOL_SIZE))
+    return pool
+
+
+@contextmanager
+def get_connection(db_path: str) -> Iterator[sqlite3.Connection]:
+    """
+    Wypożycza połączenie z puli dla danego pliku bazy i oddaje je po
+    wyjściu z bloku with. Niezatwierdzona transakcja jest wycofywana.
+    """
+    pool = _get_pool(db_path)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_connection(db_path)
+
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+@atexit.register
+def close_all_connections() -> None:
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        while True:
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                # zalecane przez SQLite przed zamknięciem połączenia – odświeża
+                # statystyki planera tylko tam, gdzie są nieaktualne
+                conn.execute("PRAGMA optimize")
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+
+def encoding_to_blob(encoding) -> sqlite3.Binary:
+    return sqlite3.Binary(np.asarray(encoding, dtype=np.float32).tobytes())
+
+
+def blob_to_encoding(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+# Wersja schematu zapisywana w PRAGMA user_version. Baza w bieżącej wersji
+# nie wymaga żadnych CREATE/ALTER przy starcie aplikacji.
+SCHEMA_VERSION = 1
+
+
+def _schema_version(cur: sqlite3.Cursor) -> int:
+    return cur.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _has_planner_stats(cur: sqlite3.Cursor) -> bool:
+    cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+    )
+    if cur.fetchone() is None:
+        return False
+    return cur.execute("SELECT 1 FROM sqlite_stat1 LIMIT 1").fetchone() is not None
+
+
 def init_db(db_path: str) -> None:
-    conn = get_connection(db_path)
+    with get_connection(db_path) as conn:
+        cur = conn.cursor()
+        if _schema_version(cur) < SCHEMA_VERSION:
+            _migrate(conn)
+
+        # Statystyki dla planera zbieramy, dopóki ich nie ma. Na świeżej
+        # bazie tabele są puste i ANALYZE nic nie zapisuje, więc sprawdzamy
+        # to przy każdym starcie, a nie tylko podczas migracji.
+        if not _has_planner_stats(cur):
+            cur.execute("ANALYZE")
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
     cur = conn.cursor()
 
+    # Cała migracja w jednej transakcji (jeden commit zamiast osobnego
+    # dla każdego polecenia). IMMEDIATE od razu blokuje zapis, więc gdy
+    # kilka procesów startuje naraz, migrację wykona tylko pierwszy.
+    cur.execute("BEGIN IMMEDIATE")
+    if _schema_version(cur) >= SCHEMA_VERSION:
+        conn.rollback()
+        return
+
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
             qr_code TEXT NOT NULL UNIQUE,
-            face_encoding TEXT NOT NULL
+            face_encoding BLOB NOT NULL
         );
         """
     )
@@ -35,27 +176,250 @@ def init_db(db_path: str) -> None:
         """
     )
 
+    # Wektory twarzy trzymamy jako surowe float32 (512 B) zamiast JSON-a
+    # (~3 KB tekstu); starsze wiersze zapisane jako tekst przepisujemy.
+    cur.execute(
+        "SELECT id, face_encoding FROM users WHERE typeof(face_encoding) = 'text'"
+    )
+    legacy_rows = cur.fetchall()
+    cur.executemany(
+        "UPDATE users SET face_encoding = ? WHERE id = ?",
+        [
+            (encoding_to_blob(json.loads(row["face_encoding"])), row["id"])
+            for row in legacy_rows
+        ],
+    )
+
+    cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     conn.commit()
-    conn.close()
+
+
+# Użytkownicy odczytani po kodzie QR, razem z już sparsowanym wektorem
+# twarzy (face_encoding_np), żeby /verify nie odtwarzał go przy każdym
+# skanie. Brak użytkownika nie jest cache'owany.
+USER_CACHE_SIZE = 1024
+
+_user_cache: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+_user_cache_lock = threading.Lock()
+
+
+def _invalidate_user(db_path: str, qr_code: str) -> None:
+    with _user_cache_lock:
+        _user_cache.pop((db_path, qr_code), None)
+
+
+# Jawna lista kolumn – tylko to, czego potrzebuje /verify.
+_SQL_GET_USER_BY_QR = (
+    "SELECT id, name, qr_code, face_encoding FROM users WHERE qr_code = ?"
+)
 
 
 def get_user_by_qr(db_path: str, qr_code: str) -> Optional[Dict[str, Any]]:
-    conn = get_connection(db_path)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE qr_code = ?", (qr_code,))
-    row = cur.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    key = (db_path, qr_code)
+    with _user_cache_lock:
+        user = _user_cache.get(key)
+        if user is not None:
+            _user_cache.move_to_end(key)
+            return user
+
+    with get_connection(db_path) as conn:
+        cur = conn.cursor()
+        cur.execute(_SQL_GET_USER_BY_QR, (qr_code,))
+        row = cur.fetchone()
+    if not row:
+        return None
+
+    user = dict(row)
+    user["face_encoding_np"] = blob_to_encoding(user["face_encoding"])
+    with _user_cache_lock:
+        _user_cache[key] = user
+        if len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+    return user
+
+
+# Macierz (N, 128) float32 wektorów wszystkich użytkowników do identyfikacji
+# 1:N jednym działaniem NumPy. Użytkownicy są tylko dodawani, więc MAX(id)
+# wystarcza jako wersja (wykrywa też dodania z innych procesów).
+_encoding_matrix_cache: Dict[str, Tuple[Optional[int], np.ndarray, np.ndarray]] = {}
+_encoding_matrix_lock = threading.Lock()
+
+
+_SQL_ALL_FACE_ENCODINGS = "SELECT id, face_encoding FROM users ORDER BY id"
+
+
+def get_face_encoding_matrix(db_path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Zwraca (ids, M): identyfikatory użytkowników i macierz ich wektorów twarzy."""
+    with get_connection(db_path) as conn:
+        version = conn.execute("SELECT MAX(id) FROM users").fetchone()[0]
+        cached = _encoding_matrix_cache.get(db_path)
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+
+        rows = conn.execute(_SQL_ALL_FACE_ENCODINGS).fetchall()
+
+    ids = np.fromiter((row["id"] for row in rows), dtype=np.int64, count=len(rows))
+    matrix = np.empty((len(rows), 128), dtype=np.float32)
+    for i, row in enumerate(rows):
+        matrix[i] = blob_to_encoding(row["face_encoding"])
+
+    with _encoding_matrix_lock:
+        _encoding_matrix_cache[db_path] = (version, ids, matrix)
+    return ids, matrix
+
+
+_SQL_CREATE_USER = """
+    INSERT INTO users (name, qr_code, face_encoding) VALUES (?, ?, ?)
+    ON CONFLICT(qr_code) DO NOTHING
+    RETURNING id
+"""
+
+
+def create_user(db_path: str, name: str, qr_code: str, face_encoding: np.ndarray) -> int:
+    """
+    Dodaje użytkownika jednym poleceniem (bez osobnego sprawdzania kodu QR)
+    i zwraca jego ID. Zajęty kod QR zgłaszany jest jako ValueError.
+    """
+    with get_connection(db_path) as conn:
+        row = conn.execute(
+            _SQL_CREATE_USER, (name, qr_code, encoding_to_blob(face_encoding))
+        ).fetchone()
+        conn.commit()
+    if row is None:
+        raise ValueError(f"Kod QR {qr_code!r} jest już przypisany do innego użytkownika.")
+    _invalidate_user(db_path, qr_code)
+    with _encoding_matrix_lock:
+        _encoding_matrix_cache.pop(db_path, None)
+    return row["id"]
+
+
+_SQL_INSERT_LOG = "INSERT INTO logs (user_id, timestamp, result) VALUES (?, ?, ?)"
+
+# Wpisy z insert_log trafiają do kolejki, a jeden wątek w tle zapisuje je
+# paczkami w jednej transakcji (jeden fsync na paczkę zamiast na żądanie).
+LOG_BATCH_SIZE = 50
+LOG_FLUSH_INTERVAL = 0.1
+
+_STOP = object()
+_log_writers: Dict[str, Tuple[queue.Queue, threading.Thread]] = {}
+_log_writers_lock = threading.Lock()
+
+
+def insert_logs_bulk(
+    db_path: str, logs: List[Tuple[Optional[int], datetime, str]]
+) -> None:
+    """
+    Zapisuje wiele logów (user_id, timestamp, result) jednym executemany
+    w jednej transakcji – jeden commit dla całej paczki.
+    """
+    _insert_log_rows(db_path, [_log_row(*log) for log in logs])
+
+
+def _log_row(user_id: Optional[int], timestamp: datetime, result: str) -> Tuple:
+    return (user_id, timestamp.isoformat(), result)
+
+
+def _insert_log_rows(db_path: str, rows: List[Tuple]) -> None:
+    with get_connection(db_path) as conn:
+        conn.executemany(_SQL_INSERT_LOG, rows)
+        conn.commit()
+
+
+def _flush_loop(db_path: str, log_queue: queue.Queue) -> None:
+    stop = False
+    while not stop:
+        item = log_queue.get()
+        if item is _STOP:
+            return
+
+        rows = [item]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while len(rows) < LOG_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = log_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stop = True
+                break
+            rows.append(item)
+
+        # błąd jednej paczki nie może zatrzymać wątku – kolejne logi
+        # trafiałyby do kolejki bez zapisu
+        try:
+            _insert_log_rows(db_path, rows)
+        except Exception:
+            traceback.print_exc()
+
+
+def start_log_writer(db_path: str) -> None:
+    """
+    Uruchamia wątek w tle, który zapisuje logi z insert_log paczkami.
+    Bez uruchomionego wątku insert_log zapisuje synchronicznie.
+    """
+    with _log_writers_lock:
+        if db_path in _log_writers:
+            return
+        log_queue: queue.Queue = queue.Queue()
+        thread = threading.Thread(
+            target=_flush_loop,
+            args=(db_path, log_queue),
+            name="log-writer",
+            daemon=True,
+        )
+        _log_writers[db_path] = (log_queue, thread)
+        thread.start()
+
+
+@atexit.register
+def stop_log_writers() -> None:
+    # rejestrowane po close_all_connections, więc atexit wywoła je wcześniej
+    with _log_writers_lock:
+        writers = list(_log_writers.values())
+        _log_writers.clear()
+    for log_queue, thread in writers:
+        log_queue.put(_STOP)
+    for log_queue, thread in writers:
+        thread.join()
 
 
 def insert_log(db_path: str, user_id: Optional[int], timestamp, result: str) -> None:
-    conn = get_connection(db_path)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO logs (user_id, timestamp, result) VALUES (?, ?, ?)",
-        (user_id, timestamp.isoformat(), result),
-    )
-    conn.commit()
-    conn.close()
+    writer = _log_writers.get(db_path)
+    if writer is None:
+        insert_logs_bulk(db_path, [(user_id, timestamp, result)])
+        return
+    # wiersz formatujemy w wątku wywołującym, więc błędne dane zgłaszane są
+    # tutaj, a do wątku zapisu trafiają gotowe wartości
+    writer[0].put(_log_row(user_id, timestamp, result))
+
+
+# Po fork() (np. gunicorn --preload) proces potomny nie może korzystać
+# z połączeń SQLite otwartych przez rodzica, a wątku zapisu logów w nim
+# nie ma. Odziedziczone obiekty tylko przechowujemy (zamknięcie ich
+# w potomku mogłoby naruszyć blokady i plik WAL rodzica) i zaczynamy od nowa.
+_inherited_from_parent: List[Any] = []
+
+
+def _after_fork_in_child() -> None:
+    global _pools, _pools_lock, _log_writers_lock, _user_cache_lock
+    global _encoding_matrix_lock
+
+    _inherited_from_parent.extend(_pools.values())
+    _inherited_from_parent.extend(_log_writers.values())
+    _pools = {}
+    _pools_lock = threading.Lock()
+    _user_cache_lock = threading.Lock()
+    _encoding_matrix_lock = threading.Lock()
+    _log_writers_lock = threading.Lock()
+
+    db_paths = list(_log_writers)
+    _log_writers.clear()
+    for db_path in db_paths:
+        start_log_writer(db_path)
 
 
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,50 +1,183 @@
-import base64
-import json
-from typing import Dict, Any
+import binascii
+import math
+from typing import Dict, Any, Optional, Tuple, Union
 
 import cv2
 import numpy as np
 import face_recognition
 
-from .database import get_connection
+from .database import create_user, blob_to_encoding, get_face_encoding_matrix
 
 
-def _decode_base64_to_rgb(b64_string: str) -> np.ndarray:
-    if "," in b64_string:
-        b64_string = b64_string.split(",", 1)[1]
+# domyślny próg z biblioteki face_recognition to ok. 0.6
+FACE_DISTANCE_THRESHOLD = 0.6
+
+
+# Nowsze OpenCV (IMREAD_COLOR_RGB) dekoduje od razu do RGB, bez osobnego
+# przebiegu cvtColor po całym obrazie. dlib wymaga ciągłej tablicy, więc
+# widok bgr[:, :, ::-1] nie wystarczy – przy starszym OpenCV zostaje cvtColor.
+_IMREAD_COLOR_RGB = getattr(cv2, "IMREAD_COLOR_RGB", None)
+
+
+# Źródło obrazu: data URL / czysty base64 (str), zakodowany plik obrazu
+# (bytes, bytearray, memoryview) albo gotowa tablica RGB.
+ImageSource = Union[str, bytes, bytearray, memoryview, np.ndarray]
+
+
+def _to_rgb(source: ImageSource) -> Optional[np.ndarray]:
+    if isinstance(source, np.ndarray):
+        return source
+
+    if isinstance(source, str):
+        head, sep, tail = source.partition(",")
+        source = binascii.a2b_base64(tail if sep else head)
+
+    # np.frombuffer tylko opakowuje bufor – bez kopiowania bajtów
+    nparr = np.frombuffer(source, np.uint8)
+    if _IMREAD_COLOR_RGB is not None:
+        return cv2.imdecode(nparr, _IMREAD_COLOR_RGB)
 
-    img_data = base64.b64decode(b64_string)
-    nparr = np.frombuffer(img_data, np.uint8)
     bgr = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     if bgr is None:
         return None
-    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
-    return rgb
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
 
 
-def compare_face_with_user(db_path: str, user_row: Dict[str, Any], frame_b64: str) -> bool:
+def extract_encoding(
+    source: ImageSource,
+    known_location: Optional[Tuple[int, int, int, int]] = None,
+) -> Optional[np.ndarray]:
+    """
+    Wyznacza wektor twarzy z dowolnego źródła obrazu (zob. ImageSource).
+    Zwraca None, jeśli obrazu nie da się zdekodować lub nie ma na nim twarzy.
+    """
+    rgb_image = _to_rgb(source)
+    if rgb_image is None:
+        return None
+    return extract_face_encoding_from_rgb(rgb_image, known_location)
+
+
+# Margines wokół prostokąta z testu żywotności (ułamek jego szerokości
+# i wysokości), w którym szukamy twarzy detektorem HOG.
+FACE_BOX_MARGIN = 0.25
+
+
+def _locate_face_near(
+    rgb_image: np.ndarray, face_box: Tuple[float, float, float, float]
+) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Wykrywa twarz detektorem face_recognition (HOG) tylko w otoczeniu
+    prostokąta z testu żywotności i zwraca jej położenie (top, right,
+    bottom, left) we współrzędnych całego obrazu lub None.
+
+    Prostokąt punktów MediaPipe (od czoła po brodę) jest większy i inaczej
+    ustawiony niż prostokąt detektora dlib, z którym wyznaczane są wektory
+    przy dodawaniu użytkownika – dlatego nie przekazujemy go bezpośrednio,
+    a jedynie zawężamy nim obszar wykrywania.
+    """
+    h, w = rgb_image.shape[:2]
+    left, top, right, bottom = face_box
+    margin_x = (right - left) * FACE_BOX_MARGIN
+    margin_y = (bottom - top) * FACE_BOX_MARGIN
+    x0 = max(0, int((left - margin_x) * w))
+    y0 = max(0, int((top - margin_y) * h))
+    x1 = min(w, math.ceil((right + margin_x) * w))
+    y1 = min(h, math.ceil((bottom + margin_y) * h))
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    # dlib wymaga ciągłej tablicy, a wycinek nią nie jest
+    crop = np.ascontiguousarray(rgb_image[y0:y1, x0:x1])
+    locations = face_recognition.face_locations(crop)
+    if not locations:
+        return None
+
+    t, r, b, l = max(locations, key=lambda loc: (loc[2] - loc[0]) * (loc[1] - loc[3]))
+    return t + y0, r + x0, b + y0, l + x0
+
+
+def compare_face_with_user(
+    db_path: str,
+    user_row: Dict[str, Any],
+    frame_b64: str,
+    frame_bgr: Optional[np.ndarray] = None,
+    face_box: Optional[Tuple[float, float, float, float]] = None,
+) -> bool:
     """
     Pobiera zakodowaną twarz użytkownika z DB i porównuje z twarzą
     wyciągniętą z przesłanej klatki (frame_b64).
+    Jeżeli podano frame_bgr (już zdekodowaną klatkę), frame_b64 nie jest
+    dekodowany ponownie. Jeżeli podano face_box (prostokąt twarzy z testu
+    żywotności, jako ułamki wymiarów obrazu), twarz wyszukiwana jest tylko
+    w jego otoczeniu, a nie w całej klatce.
     """
-    rgb_image = _decode_base64_to_rgb(frame_b64)
+    if frame_bgr is not None:
+        rgb_image = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
+    else:
+        rgb_image = _to_rgb(frame_b64)
     if rgb_image is None:
         return False
 
-    boxes = face_recognition.face_locations(rgb_image)
-    encodings = face_recognition.face_encodings(rgb_image, boxes)
-    if not encodings:
+    known_location = None
+    if face_box is not None:
+        # bez twarzy w otoczeniu prostokąta wykrywamy ją w całej klatce
+        known_location = _locate_face_near(rgb_image, face_box)
+
+    candidate_encoding = extract_face_encoding_from_rgb(rgb_image, known_location)
+    if candidate_encoding is None:
         return False
 
-    candidate_encoding = encodings[0]
+    # get_user_by_qr dostarcza wektor już odtworzony z BLOB-a
+    known_encoding = user_row.get("face_encoding_np")
+    if known_encoding is None:
+        known_encoding = blob_to_encoding(user_row["face_encoding"])
+
+    # to samo co face_recognition.face_distance, bez opakowywania w listę
+    distance = float(np.linalg.norm(known_encoding - candidate_encoding))
+    return distance < FACE_DISTANCE_THRESHOLD
+
+
+def identify_face(db_path: str, rgb_image: np.ndarray) -> Optional[int]:
+    """
+    Identyfikacja 1:N – zwraca ID najbliższego użytkownika, jeżeli jego
+    wektor twarzy mieści się w progu, w przeciwnym razie None.
+    Odległości do wszystkich użytkowników liczone są jednym działaniem
+    na macierzy (N, 128).
+    """
+    candidate_encoding = extract_face_encoding_from_rgb(rgb_image)
+    if candidate_encoding is None:
+        return None
+
+    ids, matrix = get_face_encoding_matrix(db_path)
+    if not len(ids):
+        return None
 
-    known_encoding = np.array(json.loads(user_row["face_encoding"]))
+    distances = np.linalg.norm(matrix - candidate_encoding, axis=1)
+    best = int(np.argmin(distances))
+    if distances[best] >= FACE_DISTANCE_THRESHOLD:
+        return None
+    return int(ids[best])
 
-    distances = face_recognition.face_distance([known_encoding], candidate_encoding)
-    distance = float(distances[0])
 
-    # domyślny próg z biblioteki face_recognition to ok. 0.6
-    return distance < 0.6
+def extract_face_encoding_from_rgb(
+    rgb_image: np.ndarray,
+    known_location: Optional[Tuple[int, int, int, int]] = None,
+) -> Optional[np.ndarray]:
+    """
+    Zwraca wektor twarzy (128 wartości float32) pierwszej wykrytej twarzy
+    lub None, jeśli na obrazie nie ma twarzy.
+    known_location (top, right, bottom, left) pomija wykrywanie twarzy
+    (face_locations), które jest najdroższym krokiem.
+    """
+    if known_location is not None:
+        boxes = [known_location]
+    else:
+        boxes = face_recognition.face_locations(rgb_image)
+    encodings = face_recognition.face_encodings(rgb_image, boxes)
+    if not encodings:
+        return None
+    # float32 wystarcza do progu odległości i zgadza się z zapisem w bazie
+    return encodings[0].astype(np.float32)
 
 
 def add_user_with_image(db_path: str, name: str, qr_code: str, image_path: str) -> int:
@@ -54,23 +187,8 @@ def add_user_with_image(db_path: str, name: str, qr_code: str, image_path: str)
     Zwraca ID nowo dodanego użytkownika.
     """
     image = face_recognition.load_image_file(image_path)
-    boxes = face_recognition.face_locations(image)
-    encodings = face_recognition.face_encodings(image, boxes)
-    if not encodings:
+    encoding = extract_encoding(image)
+    if encoding is None:
         raise ValueError("Nie udało się wyznaczyć wektora twarzy z podanego zdjęcia.")
 
-    encoding = encodings[0]
-    encoding_json = json.dumps(encoding.tolist())
-
-    conn = get_connection(db_path)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO users (name, qr_code, face_encoding) VALUES (?, ?, ?)",
-        (name, qr_code, encoding_json),
-    )
-    conn.commit()
-    user_id = cur.lastrowid
-    conn.close()
-    return user_id
-
-
+    return create_user(db_path, name, qr_code, encoding)
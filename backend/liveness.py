@@ -1,5 +1,10 @@
-import base64
-from typing import List
+import binascii
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 import cv2
 import numpy as np
@@ -9,93 +14,215 @@ import mediapipe as mp
 LEFT_EYE_IDX = [33, 160, 158, 133, 153, 144]
 RIGHT_EYE_IDX = [263, 387, 385, 362, 380, 373]
 
+# Punkty obu oczu w jednej liście oraz pary (p2, p6), (p3, p5), (p1, p4)
+# w obrębie oka dla wzoru EAR.
+_BOTH_IDX = LEFT_EYE_IDX + RIGHT_EYE_IDX
+_PAIR_A = np.array([1, 2, 0], dtype=np.intp)
+_PAIR_B = np.array([5, 4, 3], dtype=np.intp)
+
 EAR_THRESHOLD = 0.21
 CONSEC_FRAMES_FOR_BLINK = 2
+MIN_FRAMES = 3
+
+# Klatki do testu żywotności dekodujemy równolegle (cv2.imdecode zwalnia GIL)
+# i od razu w połowie rozdzielczości: libjpeg-turbo w OpenCV skaluje JPEG
+# już w domenie DCT, więc to szybsze niż pełne dekodowanie i resize.
+# Do EAR wystarcza połowa rozdzielczości, bo to stosunek odległości.
+LIVENESS_DECODE_FLAGS = cv2.IMREAD_REDUCED_COLOR_2
+
+_decode_pool = ThreadPoolExecutor(
+    max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="frame-decode"
+)
+
+
+# Budowa grafu MediaPipe i ładowanie modelu TFLite trwa dłużej niż samo
+# przetworzenie ~20 klatek, więc każdy wątek trzyma jedną instancję FaceMesh.
+# Instancja obsługuje kolejne, niezwiązane ze sobą żądania, dlatego działa
+# w trybie zdjęć (static_image_mode=True): tryb wideo śledziłby twarz od
+# ostatniej klatki poprzedniego żądania, a Python API nie pozwala tego stanu
+# wyczyścić bez ponownego uruchomienia grafu.
+_tls = threading.local()
+
 
+def _get_face_mesh():
+    face_mesh = getattr(_tls, "face_mesh", None)
+    if face_mesh is None:
+        face_mesh = _tls.face_mesh = mp.solutions.face_mesh.FaceMesh(
+            static_image_mode=True,
+            max_num_faces=1,
+            refine_landmarks=True,
+            min_detection_confidence=0.5,
+        )
+    return face_mesh
 
-def _decode_base64_image(b64_string: str):
+
+def decode_base64_image(b64_string: str, flags: int = cv2.IMREAD_COLOR):
     """
     Przyjmuje data URL (data:image/jpeg;base64,...) lub czysty base64
     i zwraca obraz BGR (numpy array) lub None.
     """
-    if "," in b64_string:
-        b64_string = b64_string.split(",", 1)[1]
+    # prefiks "data:...;base64," odcinamy jednym przebiegiem do przecinka
+    head, sep, tail = b64_string.partition(",")
+    b64_string = tail if sep else head
 
     try:
-        img_data = base64.b64decode(b64_string)
+        # a2b_base64 pomija znaki spoza alfabetu (np. nowe linie) i nie
+        # waliduje wejścia osobnym przebiegiem jak base64.b64decode
+        img_data = binascii.a2b_base64(b64_string)
         nparr = np.frombuffer(img_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        img = cv2.imdecode(nparr, flags)
         return img
     except Exception:
         return None
 
 
-def _eye_aspect_ratio(landmarks, eye_indices, img_w: int, img_h: int) -> float:
-    points = []
-    for idx in eye_indices:
-        lm = landmarks[idx]
-        points.append(np.array([lm.x * img_w, lm.y * img_h]))
+def _eye_points(landmarks, img_w: int, img_h: int) -> np.ndarray:
+    """Współrzędne (w pikselach) punktów p1..p6 obu oczu jako tablica (2, 6, 2)."""
+    return np.array(
+        [(landmarks[idx].x * img_w, landmarks[idx].y * img_h) for idx in _BOTH_IDX]
+    ).reshape(2, 6, 2)
+
+
+def _eyes_aspect_ratio(landmarks, img_w: int, img_h: int) -> float:
+    """
+    Średni EAR obu oczu. Punkty p1..p6 obu oczu zbieramy do jednej tablicy
+    (2, 6, 2) i liczymy obie wartości jednym wywołaniem np.linalg.norm.
+    """
+    pts = _eye_points(landmarks, img_w, img_h)
 
-    p1, p2, p3, p4, p5, p6 = points
     # (|p2 - p6| + |p3 - p5|) / (2 * |p1 - p4|)
-    numerator = np.linalg.norm(p2 - p6) + np.linalg.norm(p3 - p5)
-    denominator = 2.0 * np.linalg.norm(p1 - p4)
-    if denominator == 0:
-        return 0.0
-    return float(numerator / denominator)
+    dists = np.linalg.norm(pts[:, _PAIR_A] - pts[:, _PAIR_B], axis=2)
+    numerator = dists[:, 0] + dists[:, 1]
+    denominator = 2.0 * dists[:, 2]
+    ears = np.divide(
+        numerator, denominator, out=np.zeros(2), where=denominator != 0
+    )
+    return float(ears.mean())
 
 
-def is_live_from_base64_frames(frames_b64: List[str]) -> bool:
+# MediaPipe kosztuje mniej więcej proporcjonalnie do liczby pikseli, a EAR
+# to stosunek odległości, więc klatki zmniejszamy (z zachowaniem proporcji,
+# bez powiększania) do mieszczących się w tym rozmiarze.
+LIVENESS_MAX_SIZE = (320, 240)
+
+
+def _downscale_for_mesh(img: np.ndarray) -> np.ndarray:
+    h, w = img.shape[:2]
+    scale = min(LIVENESS_MAX_SIZE[0] / w, LIVENESS_MAX_SIZE[1] / h)
+    if scale >= 1.0:
+        return img
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def decode_frames_for_liveness(frames_b64: List[str]) -> Iterator[np.ndarray]:
     """
-    Bardzo prosty test żywotności:
-    - Dekoduje serię klatek.
-    - Oblicza EAR (Eye Aspect Ratio) dla lewego i prawego oka.
-    - Jeżeli w sekwencji nastąpi spadek EAR poniżej progu przez kilka klatek,
-      uznajemy to za mrugnięcie -> osoba "żywa".
+    Dekoduje klatki base64 równolegle i zwraca je w kolejności wejściowej,
+    pomijając te, których nie udało się zdekodować. Klatki są zwracane
+    w miarę dekodowania, więc MediaPipe może przetwarzać klatkę N, gdy
+    kolejne są jeszcze dekodowane.
     """
-    decoded_frames = []
-    for b64 in frames_b64:
-        img = _decode_base64_image(b64)
-        if img is not None:
-            decoded_frames.append(img)
+    decode = partial(decode_base64_image, flags=LIVENESS_DECODE_FLAGS)
+    return (img for img in _decode_pool.map(decode, frames_b64) if img is not None)
 
-    if len(decoded_frames) < 3:
-        # za mało klatek, by sensownie ocenić mrugnięcie
-        return False
 
-    mp_face_mesh = mp.solutions.face_mesh
+# Prostokąt wokół punktów twarzy z MediaPipe w ostatniej klatce, jako ułamki
+# szerokości/wysokości obrazu: (left, top, right, bottom). Wskazuje, gdzie
+# szukać twarzy – nie jest prostokątem w konwencji detektora dlib.
+FaceBox = Tuple[float, float, float, float]
+
+
+def is_live_from_base64_frames(
+    frames_b64: List[str], last_frame_bgr: Optional[np.ndarray] = None
+) -> bool:
+    return liveness_from_base64_frames(frames_b64, last_frame_bgr)[0]
 
-    blink_detected = False
-    consec_below = 0
 
-    with mp_face_mesh.FaceMesh(
-        static_image_mode=True,
-        max_num_faces=1,
-        refine_landmarks=True,
-        min_detection_confidence=0.5,
-    ) as face_mesh:
-        for img in decoded_frames:
-            rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            result = face_mesh.process(rgb)
+def liveness_from_base64_frames(
+    frames_b64: List[str], last_frame_bgr: Optional[np.ndarray] = None
+) -> Tuple[bool, Optional[FaceBox]]:
+    """
+    Dekoduje serię klatek i uruchamia test żywotności (liveness_from_frames).
+
+    Jeżeli podano last_frame_bgr (już zdekodowaną ostatnią klatkę),
+    ostatni element frames_b64 nie jest dekodowany ponownie.
+    """
+    if len(frames_b64) < MIN_FRAMES:
+        return False, None
 
-            if not result.multi_face_landmarks:
-                consec_below = 0
-                continue
+    if last_frame_bgr is not None:
+        frames_b64 = frames_b64[:-1]
 
-            face_landmarks = result.multi_face_landmarks[0].landmark
-            h, w, _ = img.shape
+    decoded_frames: Iterable[np.ndarray] = decode_frames_for_liveness(frames_b64)
 
-            left_ear = _eye_aspect_ratio(face_landmarks, LEFT_EYE_IDX, w, h)
-            right_ear = _eye_aspect_ratio(face_landmarks, RIGHT_EYE_IDX, w, h)
-            ear = (left_ear + right_ear) / 2.0
+    if last_frame_bgr is not None:
+        decoded_frames = chain(decoded_frames, [last_frame_bgr])
 
-            if ear < EAR_THRESHOLD:
-                consec_below += 1
-                if consec_below >= CONSEC_FRAMES_FOR_BLINK:
-                    blink_detected = True
-            else:
-                consec_below = 0
+    return liveness_from_frames(decoded_frames)
 
-    return blink_detected
 
+def is_live_from_frames(decoded_frames: Iterable[np.ndarray]) -> bool:
+    return liveness_from_frames(decoded_frames)[0]
+
+
+def _face_box(landmarks) -> FaceBox:
+    coords = np.fromiter(
+        (c for lm in landmarks for c in (lm.x, lm.y)),
+        dtype=np.float64,
+        count=2 * len(landmarks),
+    ).reshape(-1, 2)
+    left, top = np.clip(coords.min(axis=0), 0.0, 1.0)
+    right, bottom = np.clip(coords.max(axis=0), 0.0, 1.0)
+    return float(left), float(top), float(right), float(bottom)
+
+
+def liveness_from_frames(
+    decoded_frames: Iterable[np.ndarray],
+) -> Tuple[bool, Optional[FaceBox]]:
+    """
+    Bardzo prosty test żywotności:
+    - Przyjmuje serię zdekodowanych klatek BGR (listę lub iterator).
+    - Oblicza EAR (Eye Aspect Ratio) dla lewego i prawego oka.
+    - Jeżeli w sekwencji nastąpi spadek EAR poniżej progu przez kilka klatek,
+      uznajemy to za mrugnięcie -> osoba "żywa".
+
+    Zwraca też prostokąt twarzy wykrytej w ostatniej klatce (lub None),
+    żeby porównanie twarzy nie musiało jej ponownie wyszukiwać.
+    """
+    face_mesh = _get_face_mesh()
+
+    blink_detected = False
+    consec_below = 0
+    frame_count = 0
+    last_landmarks = None
+
+    for img in decoded_frames:
+        frame_count += 1
+        small = _downscale_for_mesh(img)
+        rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+        result = face_mesh.process(rgb)
+
+        if not result.multi_face_landmarks:
+            consec_below = 0
+            last_landmarks = None
+            continue
+
+        face_landmarks = result.multi_face_landmarks[0].landmark
+        last_landmarks = face_landmarks
+        h, w, _ = small.shape
+
+        ear = _eyes_aspect_ratio(face_landmarks, w, h)
+
+        if ear < EAR_THRESHOLD:
+            consec_below += 1
+            if consec_below >= CONSEC_FRAMES_FOR_BLINK:
+                blink_detected = True
+        else:
+            consec_below = 0
+
+    if frame_count < MIN_FRAMES:
+        # za mało klatek, by sensownie ocenić mrugnięcie
+        return False, None
 
+    face_box = _face_box(last_landmarks) if last_landmarks is not None else None
+    return blink_detected, face_box
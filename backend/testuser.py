@@ -1,16 +1,33 @@
-   # przykład – dopasuj ścieżki do siebie
-import os
-from backend.face_utils import add_user_with_image
-
-base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))  # katalog projektu
-db_path = os.path.join(base_dir, "backend", "database.sqlite3")
-
-user_id = add_user_with_image(
-    db_path=db_path,
-    name="username",
-    qr_code="qr_number_code",           
-    image_path=r"C:\Users\mateo\OneDrive\Pulpit\face-qr-auth-system\image.jpg"
-)
-
-
-print("Dodano usera o ID:", user_id)
+# przykład – dodanie użytkownika na podstawie zdjęcia:
+#   python -m backend.testuser username qr_number_code C:\sciezka\do\image.jpg
+import argparse
+import os
+
+from backend.database import init_db
+from backend.face_utils import add_user_with_image
+
+
+def main() -> None:
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))  # katalog projektu
+    default_db_path = os.path.join(base_dir, "backend", "database.sqlite3")
+
+    parser = argparse.ArgumentParser(description="Dodaje użytkownika do bazy na podstawie zdjęcia twarzy.")
+    parser.add_argument("name", help="nazwa użytkownika")
+    parser.add_argument("qr_code", help="kod QR przypisany użytkownikowi")
+    parser.add_argument("image_path", help="ścieżka do zdjęcia twarzy")
+    parser.add_argument("--db-path", default=default_db_path, help="ścieżka do pliku bazy SQLite")
+    args = parser.parse_args()
+
+    init_db(args.db_path)
+    user_id = add_user_with_image(
+        db_path=args.db_path,
+        name=args.name,
+        qr_code=args.qr_code,
+        image_path=args.image_path,
+    )
+
+    print("Dodano usera o ID:", user_id)
+
+
+if __name__ == "__main__":
+    main()
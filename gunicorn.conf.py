@@ -0,0 +1,17 @@
+import multiprocessing
+
+bind = "0.0.0.0:5000"
+
+# Kilka procesów z wątkami zamiast jednowątkowego serwera deweloperskiego.
+# Dzięki preload_app aplikacja (razem z modelami dlib ładowanymi przy
+# imporcie face_recognition) ładuje się raz w procesie głównym i jest
+# współdzielona przez workery kopiowaniem przy zapisie. FaceMesh z MediaPipe
+# tworzy się dopiero przy pierwszym użyciu, osobno w każdym wątku workera
+# (liveness._get_face_mesh).
+workers = multiprocessing.cpu_count()
+worker_class = "gthread"
+threads = 2
+preload_app = True
+
+# Weryfikacja twarzy potrafi trwać kilka sekund na słabszym CPU.
+timeout = 60
@@ -0,0 +1,16 @@
+from backend.app import create_app
+
+
+def test_verify_accepts_json_body(tmp_path):
+    app = create_app(db_path=str(tmp_path / "database.sqlite3"))
+
+    # klatki, których nie da się zdekodować – żądanie jest poprawne,
+    # ale test żywotności nie wykryje mrugnięcia
+    frame = "data:image/jpeg;base64,AAAA"
+    res = app.test_client().post(
+        "/verify", json={"qr_code": "123456", "frames": [frame] * 3}
+    )
+
+    assert res.status_code == 200
+    assert res.is_json
+    assert res.get_json()["status"] == "spoofing"
@@ -0,0 +1,28 @@
+from datetime import datetime
+
+from backend.database import get_connection, init_db, insert_log, insert_logs_bulk
+
+
+def _read_logs(db_path):
+    with get_connection(db_path) as conn:
+        rows = conn.execute(
+            "SELECT user_id, timestamp, result FROM logs ORDER BY id"
+        ).fetchall()
+    return [tuple(row) for row in rows]
+
+
+def test_insert_logs_bulk_writes_all_rows(tmp_path):
+    db_path = str(tmp_path / "database.sqlite3")
+    init_db(db_path)
+    t1 = datetime(2024, 5, 1, 12, 0, 0)
+    t2 = datetime(2024, 5, 1, 12, 0, 1, 500000)
+
+    insert_logs_bulk(db_path, [(None, t1, "Spoofing"), (7, t2, "Sukces")])
+    # bez wątku zapisu insert_log zapisuje od razu przez insert_logs_bulk
+    insert_log(db_path, 7, t2, "Oszustwo")
+
+    assert _read_logs(db_path) == [
+        (None, "2024-05-01T12:00:00", "Spoofing"),
+        (7, "2024-05-01T12:00:01.500000", "Sukces"),
+        (7, "2024-05-01T12:00:01.500000", "Oszustwo"),
+    ]
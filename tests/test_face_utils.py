@@ -0,0 +1,62 @@
+import numpy as np
+
+from backend import face_utils
+from backend.database import (
+    create_user,
+    encoding_to_blob,
+    get_connection,
+    get_face_encoding_matrix,
+    init_db,
+)
+
+
+def _encoding(value: float) -> np.ndarray:
+    encoding = np.zeros(128, dtype=np.float32)
+    encoding[0] = value
+    return encoding
+
+
+def test_identify_face_returns_nearest_user_within_threshold(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "database.sqlite3")
+    init_db(db_path)
+
+    alice = create_user(db_path, "Alice", "qr-alice", _encoding(0.0))
+    ids, _ = get_face_encoding_matrix(db_path)
+    assert ids.tolist() == [alice]
+
+    bob = create_user(db_path, "Bob", "qr-bob", _encoding(1.0))
+    ids, matrix = get_face_encoding_matrix(db_path)
+    assert ids.tolist() == [alice, bob]
+    np.testing.assert_array_equal(matrix[1], _encoding(1.0))
+
+    def identify(candidate):
+        monkeypatch.setattr(
+            face_utils, "extract_face_encoding_from_rgb", lambda rgb: candidate
+        )
+        return face_utils.identify_face(db_path, np.zeros((1, 1, 3), np.uint8))
+
+    assert identify(_encoding(0.2)) == alice
+    assert identify(_encoding(0.9)) == bob
+    assert identify(_encoding(5.0)) is None
+
+
+def test_encoding_matrix_is_rebuilt_after_insert_from_another_process(tmp_path):
+    db_path = str(tmp_path / "database.sqlite3")
+    init_db(db_path)
+    create_user(db_path, "Alice", "qr-alice", _encoding(0.0))
+
+    ids, matrix = get_face_encoding_matrix(db_path)
+    assert get_face_encoding_matrix(db_path)[1] is matrix
+
+    # zapis z pominięciem create_user (jak z innego procesu) – cache
+    # wykrywa go po zmianie MAX(id)
+    with get_connection(db_path) as conn:
+        conn.execute(
+            "INSERT INTO users (name, qr_code, face_encoding) VALUES (?, ?, ?)",
+            ("Bob", "qr-bob", encoding_to_blob(_encoding(1.0))),
+        )
+        conn.commit()
+
+    ids, matrix = get_face_encoding_matrix(db_path)
+    assert len(ids) == 2
+    np.testing.assert_array_equal(matrix[1], _encoding(1.0))
@@ -0,0 +1,8 @@
+"""
+Punkt wejścia WSGI dla serwera produkcyjnego, np.:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from backend.app import create_app
+
+app = create_app()